@@ -0,0 +1,206 @@
+"""
+xml_to_csv_ftp checks
+=====================
+parse_xml is compared with the output of the original str.find-based parser:
+EXPECTED rows were produced by the pre-iterparse parser on the same input.
+Stray '&', '<' and invalid UTF-8 bytes the string parser read as text are
+escaped or replaced and re-parsed; anything still not well-formed fails the
+whole file (None) rather than come back with missing rows.
+
+SFMC calls go to a stub CLIENT, processed-log reads and writes to a fake SFTP.
+"""
+
+import gzip
+from io import BytesIO
+from types import SimpleNamespace
+
+import orjson
+import pytest
+
+import xml_to_csv_ftp
+from xml_to_csv_ftp import parse_xml
+
+# =============================================================================
+# PARSER
+# =============================================================================
+
+def prog(ref, nom, url, extra="", cp="75011"):
+    return (f"<PROGRAMME><REF_OPERATION>{ref}</REF_OPERATION><NOM>{nom}</NOM>"
+            f"<LOCALISATION><VILLE>Paris</VILLE><CP>{cp}</CP><DEPARTEMENT>75</DEPARTEMENT></LOCALISATION>"
+            f"{extra}<LIENS><URL>https://x.fr/a</URL><URL> {url} </URL></LIENS></PROGRAMME>")
+
+def document(*programs, tail=""):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<REPONSE>'
+            + "".join(programs) + "</REPONSE>" + tail).encode("utf-8")
+
+def parse(xml):
+    rows = parse_xml(BytesIO(xml))
+    if rows is not None:
+        for r in rows: r.pop("Scraping_Date")
+    return rows
+
+def row(url, ref, name, args, image="NO IMAGE"):
+    return {
+        "Program_URL":        url,
+        "Program_Ref":        ref,
+        "Program_Name":       name,
+        "Program_City":       "Paris",
+        "Program_ZipCode":    "75011",
+        "Program_Department": "75",
+        "Program_Arguments":  args,
+        "Scraping_Status":    "SUCCESS",
+        "Error_Message":      "",
+        "Program_Image":      image,
+    }
+
+CLEAN = document(
+    prog("R1", "Résidence &amp; Parc", "https://x.fr/programme-neuf-1",
+         "<PERSPECTIVES><URL>https://img/1.jpg</URL></PERSPECTIVES>"
+         "<POINTS_FORTS><PF>Proche gare &amp; commerces</PF><PF><![CDATA[Terrasse <b>sud</b>]]></PF></POINTS_FORTS>"),
+    prog("R2", "<![CDATA[Le  Clos\n des Vignes]]>", "https://x.fr/programme-neuf-2",
+         "<DESCRIPTIF_COURT>Au calme &lt;p&gt;proche&lt;/p&gt;</DESCRIPTIF_COURT>"),
+    prog("R1", "Doublon", "https://x.fr/programme-neuf-1"),
+    prog("R3", "Sans CP", "https://x.fr/programme-neuf-3", cp=""),
+    prog("R4", "Autre", "https://x.fr/autre-4"),
+    prog("R7", "<![CDATA[A &amp; B]]>", "https://x.fr/programme-neuf-7",
+         "<DESCRIPTIF_COURT>Hello<br/>World</DESCRIPTIF_COURT>"),
+    prog("R8", "Nom", "https://x.fr/programme-neuf-8",
+         "<DESCRIPTIF_LONG><p>Hello</p><p>World</p></DESCRIPTIF_LONG>"),
+    prog("R9", "A &amp;lt;B&amp;gt; C", "https://x.fr/programme-neuf-9"),
+    tail="\ntrailing junk <<",
+)
+
+EXPECTED = [
+    row("https://x.fr/programme-neuf-1", "R1", "Résidence & Parc",
+        "Proche gare & commerces | Terrasse sud", "https://img/1.jpg"),
+    row("https://x.fr/programme-neuf-2", "R2", "Le Clos des Vignes", "Au calme proche"),
+    row("https://x.fr/programme-neuf-7", "R7", "A & B", "Hello World"),
+    row("https://x.fr/programme-neuf-8", "R8", "Nom", "Hello World"),
+    row("https://x.fr/programme-neuf-9", "R9", "A &lt;B&gt; C", "A &lt;B&gt; C"),
+]
+
+def test_matches_string_parser():
+    assert parse(CLEAN) == EXPECTED
+
+@pytest.mark.parametrize("name, url", [
+    ("Dupont & Fils", "https://x.fr/programme-neuf-5"),
+    ("Nom",           "https://x.fr/programme-neuf-5?x=1&y=2"),
+    ("A&nbsp;B",      "https://x.fr/programme-neuf-5"),
+    ("A < B",         "https://x.fr/programme-neuf-5"),
+])
+def test_stray_markup_is_read_like_string_parser(name, url):
+    good = prog("R6", "Suivant", "https://x.fr/programme-neuf-6")
+    rows = parse(document(good, prog("R5", name, url), good))
+    assert [(r["Program_Ref"], r["Program_Name"], r["Program_URL"]) for r in rows] == [
+        ("R6", "Suivant", "https://x.fr/programme-neuf-6"),
+        ("R5", name, url),
+    ]
+
+def test_cdata_is_not_escaped_again():
+    rows = parse(document(prog("R5", "<![CDATA[Tom & Jerry < 3]]>", "https://x.fr/programme-neuf-5"),
+                          prog("R6", "A & B", "https://x.fr/programme-neuf-6")))
+    assert [r["Program_Name"] for r in rows] == ["Tom & Jerry < 3", "A & B"]
+
+def test_invalid_utf8_is_replaced_like_string_parser():
+    xml = document(prog("R5", "Café", "https://x.fr/programme-neuf-5"),
+                   prog("R6", "Suivant", "https://x.fr/programme-neuf-6"))
+    rows = parse(xml.replace("é".encode(), b"\xe9"))
+    assert [r["Program_Name"] for r in rows] == ["Caf\ufffd", "Suivant"]
+
+def test_truncated_file_fails_instead_of_losing_data():
+    xml = document(*(prog(f"R{i}", "Nom", f"https://x.fr/programme-neuf-{i}") for i in range(3)))
+    assert parse(xml[:-40]) is None
+
+def test_empty_file_fails():
+    assert parse(b"") is None
+
+# =============================================================================
+# SFMC
+# =============================================================================
+
+class FakeClient:
+    """Answers each post with the next queued status, then 202"""
+    def __init__(self, *statuses):
+        self.statuses, self.posts = list(statuses), []
+
+    def post(self, url, content=None, headers=None, **kwargs):
+        self.posts.append((content, headers))
+        status = self.statuses.pop(0) if self.statuses else 202
+        return SimpleNamespace(status_code=status, text="")
+
+@pytest.fixture
+def client(monkeypatch):
+    def install(*statuses, gzip_on=False):
+        fake = FakeClient(*statuses)
+        monkeypatch.setattr(xml_to_csv_ftp, "CLIENT", fake)
+        monkeypatch.setattr(xml_to_csv_ftp, "gzip_accepted", gzip_on)
+        return fake
+    return install
+
+@pytest.mark.parametrize("status", [400, 415])
+def test_refused_gzip_is_resent_plain_once(client, status):
+    fake = client(status, gzip_on=True)
+    assert xml_to_csv_ftp.sfmc_insert_batch_async("tok", [{"Program_Ref": "R1"}]) == (1, 0)
+    (zipped, zipped_headers), (plain, plain_headers) = fake.posts
+    assert zipped_headers["Content-Encoding"] == "gzip"
+    assert "Content-Encoding" not in plain_headers
+    assert gzip.decompress(zipped) == plain
+    assert xml_to_csv_ftp.gzip_accepted is False
+
+@pytest.mark.parametrize("status", [401, 413, 429])
+def test_other_errors_keep_gzip(client, status):
+    fake = client(status, gzip_on=True)
+    assert xml_to_csv_ftp.sfmc_insert_batch_async("tok", [{"Program_Ref": "R1"}]) == (0, 1)
+    assert len(fake.posts) == 1
+    assert xml_to_csv_ftp.gzip_accepted is True
+
+def test_oversized_batch_is_split_in_half(client, monkeypatch):
+    rows = [{"Program_Ref": f"R{i}", "Program_Name": "Nom"} for i in range(4)]
+    monkeypatch.setattr(xml_to_csv_ftp, "MAX_BODY_BYTES", len(orjson.dumps({"items": rows[:2]})))
+    fake = client(500)
+    assert xml_to_csv_ftp.sfmc_insert_batch_async("tok", rows) == (2, 2)
+    sent = [orjson.loads(body)["items"] for body, _ in fake.posts]
+    assert sent == [rows[:2], rows[2:]]
+
+# =============================================================================
+# PROCESSED LOG
+# =============================================================================
+
+class FakeFile(BytesIO):
+    def __init__(self, sftp, path, mode):
+        if "r" in mode and path not in sftp.files: raise IOError(path)
+        super().__init__(sftp.files.get(path, b""))
+        self.sftp, self.path, self.mode = sftp, path, mode
+
+    def set_pipelined(self, pipelined=True): pass
+
+    def write(self, data):
+        self.sftp.writes.append((self.path, self.mode, data))
+        self.sftp.files[self.path] = self.sftp.files.get(self.path, b"") + data
+
+class FakeSFTP:
+    """Files held in a dict; every write is recorded with its open mode"""
+    def __init__(self, files=None):
+        self.files, self.writes = dict(files or {}), []
+
+    def stat(self, path): pass
+    def mkdir(self, path): pass
+    def open(self, path, mode="r"): return FakeFile(self, path, mode)
+
+@pytest.mark.parametrize("existing", [None, b"old.xml|1|2", b"old.xml|1|2\n"])
+def test_marks_are_appended_in_one_write(existing):
+    log = xml_to_csv_ftp.PROCESSED_LOG
+    sftp = FakeSFTP({} if existing is None else {log: existing})
+    marks = []
+    xml_to_csv_ftp.mark_processed(marks, "a.xml", 10, 1700000000.7)
+    xml_to_csv_ftp.mark_processed(marks, "b.xml", 20, 1700000001)
+    xml_to_csv_ftp.save_processed(sftp, marks)
+    assert sftp.writes == [(log, "a", b"\na.xml|10|1700000000\nb.xml|20|1700000001")]
+    expected = {"a.xml|10|1700000000", "b.xml|20|1700000001"}
+    if existing: expected.add("old.xml|1|2")
+    assert xml_to_csv_ftp.load_processed(sftp) == expected
+
+def test_no_marks_no_write():
+    sftp = FakeSFTP()
+    xml_to_csv_ftp.save_processed(sftp, [])
+    assert sftp.writes == []
@@ -5,14 +5,21 @@ BI XML → SFMC Data Extension (Full Pipeline) - ASYNC API VERSION
 Uses the async Data Extension API which doesn't require primary key specification
 """
 
+import gzip
 import os
 import re
+import socket
+import stat
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from io import BytesIO
+from xml.sax.saxutils import unescape
 
+import httpx
+import orjson
 import paramiko
-import requests
+from lxml import etree
 
 # =============================================================================
 # CONFIG
@@ -27,21 +34,40 @@ SFMC_CLIENT_ID     = os.environ.get("SFMC_CLIENT_ID", "")
 SFMC_CLIENT_SECRET = os.environ.get("SFMC_CLIENT_SECRET", "")
 SFMC_AUTH_BASE_URI = os.environ.get("SFMC_AUTH_BASE_URI", "")
 SFMC_REST_BASE_URI = os.environ.get("SFMC_REST_BASE_URI", "")
+# Gzip request bodies: off until the SFMC endpoint is confirmed to accept it
+SFMC_GZIP          = os.environ.get("SFMC_GZIP", "") == "1"
 
 INCOMING_DIR  = os.environ.get("INCOMING_DIR",  "/bi/incoming")
 ARCHIVE_DIR   = os.environ.get("ARCHIVE_DIR",   "/bi/archive")
 PROCESSED_LOG = os.environ.get("PROCESSED_LOG", "/bi/processed/processed.log")
 
+# Extra SFTP logins used to fetch several waiting XML files in parallel.
+# 1 = everything on the main connection, until the server's session limit is known
+FTP_WORKERS   = int(os.environ.get("FTP_WORKERS", "1"))
+
 # NOTE: Correct External Key from SFMC
 DE_EXTERNAL_KEY = "358E9826-DCC9-4611-98F1-233E639B96D3"
-BATCH_SIZE = 50
+BATCH_SIZE = 2000
+SFMC_WORKERS = 8
+
+# Batches whose JSON body exceeds this are split in half until they fit
+MAX_BODY_BYTES = 3_500_000
+
 
-XML_PATTERN = re.compile(r".*\.xml$", re.IGNORECASE)
+# Large SSH window so the server never stalls waiting for window adjusts;
+# kept to int32 range, some servers overflow on paramiko's 2**32-1 maximum
+SSH_WINDOW_SIZE = 2**31 - 1
+
+# Kernel clamps these to net.core.[rw]mem_max
+SOCKET_BUFFER_SIZE = 32 << 20
 
 # =============================================================================
 # FTP HELPERS
 # =============================================================================
 
+def is_dir(attr):
+    return stat.S_ISDIR(attr.st_mode or 0)
+
 def safe_join(d, f):
     return d.rstrip("/") + "/" + f
 
@@ -54,21 +80,42 @@ def ensure_remote_dirs(sftp, path):
             try: sftp.mkdir(dp)
             except: pass
 
-def ftp_connect():
-    print(f"[FTP] Connecting to {FTP_HOST}:{FTP_PORT}...")
-    transport = paramiko.Transport((FTP_HOST, FTP_PORT))
-    transport.connect(username=FTP_USERNAME, password=FTP_PASSWORD)
+def tcp_connect(host, port):
+    """Connect like paramiko does (any address family), with tuned socket options"""
+    err = None
+    for family, type_, proto, _, addr in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM):
+        sock = socket.socket(family, type_, proto)
+        try:
+            # Buffers must be sized before connect() for TCP window scaling to use them
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+            sock.connect(addr)
+            return sock
+        except OSError as e:
+            sock.close()
+            err = e
+    raise err or OSError(f"Could not resolve {host}")
+
+def ftp_connect(log=print):
+    log(f"[FTP] Connecting to {FTP_HOST}:{FTP_PORT}...")
+    sock = tcp_connect(FTP_HOST, FTP_PORT)
+    transport = paramiko.Transport(sock, default_window_size=SSH_WINDOW_SIZE)
+    try:
+        transport.connect(username=FTP_USERNAME, password=FTP_PASSWORD)
+    except Exception:
+        transport.close()
+        raise
     sftp = paramiko.SFTPClient.from_transport(transport)
-    print("[FTP] Connected")
+    log("[FTP] Connected")
     return transport, sftp
 
-def ftp_download(sftp, path):
-    print(f"[FTP] Downloading {path}...")
-    buf = BytesIO()
-    sftp.getfo(path, buf)
-    content = buf.getvalue().decode("utf-8", errors="replace")
-    print(f"[FTP] {len(content):,} chars")
-    return content
+def ftp_download(sftp, path, log=print):
+    """Open a remote file for streaming; prefetch keeps reads ahead of the caller"""
+    log(f"[FTP] Downloading {path}...")
+    f = sftp.open(path, "rb")
+    f.prefetch()
+    return f
 
 def ftp_rename(sftp, src, dst):
     ensure_remote_dirs(sftp, dst)
@@ -80,9 +127,10 @@ def ftp_read_text(sftp, path):
             return f.read().decode("utf-8", errors="replace")
     except: return ""
 
-def ftp_write_text(sftp, path, content):
+def ftp_append_text(sftp, path, content):
     ensure_remote_dirs(sftp, path)
-    with sftp.open(path, "w") as f:
+    with sftp.open(path, "a") as f:
+        f.set_pipelined(True)
         f.write(content.encode("utf-8"))
 
 def load_processed(sftp):
@@ -90,20 +138,24 @@ def load_processed(sftp):
     content = ftp_read_text(sftp, PROCESSED_LOG)
     return set(line.strip() for line in content.splitlines() if line.strip())
 
-def mark_processed(sftp, filename, size, mtime):
+def mark_processed(marks, filename, size, mtime):
     """Mark file as processed using filename|size|mtime format"""
     key = f"{filename}|{size}|{int(mtime)}"
-    existing = ftp_read_text(sftp, PROCESSED_LOG)
-    if existing and not existing.endswith("\n"):
-        existing += "\n"
-    ftp_write_text(sftp, PROCESSED_LOG, existing + key + "\n")
+    # Newline first: the log may not end with one, and blank lines are skipped on load
+    marks.append("\n" + key)
     print(f"[LOG] Marked as processed: {key}")
 
+def save_processed(sftp, marks):
+    """Append this run's marks to the processed log in one write"""
+    if not marks: return
+    ftp_append_text(sftp, PROCESSED_LOG, "".join(marks))
+    print(f"[LOG] Saved {len(marks)} mark(s) to {PROCESSED_LOG}")
+
 def list_incoming_xml(sftp):
     items = sftp.listdir_attr(INCOMING_DIR)
     files = []
     for it in items:
-        if not it.longname.startswith("d") and XML_PATTERN.match(it.filename):
+        if not is_dir(it) and it.filename.lower().endswith(".xml"):
             files.append((it.filename, it.st_mtime, it.st_size))
     files.sort(key=lambda x: x[1])
     return files
@@ -112,10 +164,18 @@ def list_incoming_xml(sftp):
 # SFMC REST API - ASYNC VERSION
 # =============================================================================
 
+# One HTTP/2 client for every SFMC call: concurrent batch posts are multiplexed
+# as streams over a single TLS connection per host
+CLIENT = httpx.Client(http2=True, timeout=30.0,
+                      limits=httpx.Limits(max_connections=SFMC_WORKERS))
+
+# Cleared the first time SFMC rejects a gzip-encoded body
+gzip_accepted = SFMC_GZIP
+
 def sfmc_auth():
     url = f"https://{SFMC_AUTH_BASE_URI}/v2/token"
     print("[API] Authenticating...")
-    resp = requests.post(url, json={
+    resp = CLIENT.post(url, json={
         "grant_type": "client_credentials",
         "client_id": SFMC_CLIENT_ID,
         "client_secret": SFMC_CLIENT_SECRET,
@@ -125,6 +185,18 @@ def sfmc_auth():
     print("[API] Authenticated")
     return token
 
+def sfmc_post_json(url, body, headers):
+    """POST a JSON body gzip-compressed, falling back to plain if SFMC refuses it"""
+    global gzip_accepted
+    if gzip_accepted:
+        resp = CLIENT.post(url, content=gzip.compress(body, compresslevel=1),
+                           headers={**headers, "Content-Encoding": "gzip"})
+        # Gateways that don't expect gzip answer 415 or just 400 (invalid JSON)
+        if resp.status_code not in (400, 415): return resp
+        print(f"[API] Gzip body refused (HTTP {resp.status_code}), sending uncompressed")
+        gzip_accepted = False
+    return CLIENT.post(url, content=body, headers=headers)
+
 def sfmc_insert_batch_async(token, rows):
     """Insert rows using the async Data Extension API"""
     url = f"https://{SFMC_REST_BASE_URI}/data/v1/async/dataextensions/key:{DE_EXTERNAL_KEY}/rows"
@@ -133,30 +205,17 @@ def sfmc_insert_batch_async(token, rows):
         "Content-Type": "application/json",
     }
 
-    # Format rows for the async API
-    payload = {
-        "items": []
-    }
-    
-    for row in rows:
-        payload["items"].append({
-            "Program_URL": row["Program_URL"],
-            "Program_Ref": row["Program_Ref"],
-            "Program_Name": row["Program_Name"],
-            "Program_City": row["Program_City"],
-            "Program_ZipCode": row["Program_ZipCode"],
-            "Program_Department": row["Program_Department"],
-            "Program_Arguments": row["Program_Arguments"],
-            "Scraping_Date": row["Scraping_Date"],
-            "Scraping_Status": row["Scraping_Status"],
-            "Error_Message": row["Error_Message"],
-            "Program_Image": row["Program_Image"],
-        })
-
-    resp = requests.post(url, json=payload, headers=headers)
+    # parse_xml already builds rows with exactly the DE column names
+    body = orjson.dumps({"items": rows})
+    if len(body) > MAX_BODY_BYTES and len(rows) > 1:
+        half = len(rows) // 2
+        ok1, err1 = sfmc_insert_batch_async(token, rows[:half])
+        ok2, err2 = sfmc_insert_batch_async(token, rows[half:])
+        return ok1 + ok2, err1 + err2
+
+    resp = sfmc_post_json(url, body, headers)
 
     if resp.status_code in (200, 201, 202):
-        print(f"[API] Batch accepted: {resp.status_code}")
         return len(rows), 0
     else:
         print(f"[API] Batch FAILED: HTTP {resp.status_code}")
@@ -168,12 +227,13 @@ def sfmc_insert_all(token, programs):
     total_ok = 0
     total_err = 0
 
-    for i in range(0, len(programs), BATCH_SIZE):
-        batch = programs[i:i + BATCH_SIZE]
-        ok, err = sfmc_insert_batch_async(token, batch)
-        total_ok += ok
-        total_err += err
-        print(f"[API] Batch {i // BATCH_SIZE + 1}: {ok} OK, {err} errors")
+    batches = [programs[i:i + BATCH_SIZE] for i in range(0, len(programs), BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=SFMC_WORKERS) as pool:
+        results = pool.map(lambda batch: sfmc_insert_batch_async(token, batch), batches)
+        for n, (ok, err) in enumerate(results, 1):
+            total_ok += ok
+            total_err += err
+            print(f"[API] Batch {n}: {ok} OK, {err} errors")
 
     print(f"[API] Total: {total_ok} OK, {total_err} errors")
     return total_ok, total_err
@@ -182,134 +242,211 @@ def sfmc_insert_all(token, programs):
 # XML HELPERS
 # =============================================================================
 
+DECODE_PATTERN = re.compile(r"<!\[CDATA\[([\s\S]*?)\]\]>|&(?:lt|gt|amp|quot|#39);")
+TAG_PATTERN    = re.compile(r"<[^>]*>")
+
+ENTITIES = {"&lt;": "<", "&gt;": ">", "&amp;": "&", "&quot;": '"', "&#39;": "'"}
+
+# Outside CDATA: a '&' that starts no XML entity, a '<' that starts no markup
+STRAY_PATTERN  = re.compile(rb"(<!\[CDATA\[[\s\S]*?\]\]>)|&(?!(?:lt|gt|amp|quot|apos|#[0-9]+|#x[0-9a-fA-F]+);)|<(?![A-Za-z_/!?])")
+
+def escape_stray(m):
+    if m.group(1): return m.group(1)
+    return b"&amp;" if m.group(0) == b"&" else b"&lt;"
+
+def repair_xml(raw):
+    """Read the bytes the way the old string parser did: invalid UTF-8 replaced,
+    stray '&' and '<' taken as plain text"""
+    raw = raw.decode("utf-8", errors="replace").encode("utf-8")
+    return STRAY_PATTERN.sub(escape_stray, raw)
+
+def normalize_ws(v):
+    return " ".join(v.split())
+
+def decode_match(m):
+    cdata = m.group(1)
+    if cdata is None: return ENTITIES[m.group(0)]
+    # Entities inside CDATA were decoded too when these were separate passes
+    return DECODE_PATTERN.sub(decode_match, cdata) if "&" in cdata else cdata
+
 def decode_xml(v):
     if not v: return ""
-    v = re.sub(r"<!\[CDATA\[([\s\S]*?)\]\]>", r"\1", v)
-    v = v.replace("&lt;", "<").replace("&gt;", ">")
-    v = v.replace("&amp;", "&").replace("&quot;", '"').replace("&#39;", "'")
-    return re.sub(r"\s+", " ", v).strip()
-
-def tag_value(xml, tag):
-    o, c = f"<{tag}>", f"</{tag}>"
-    s = xml.find(o)
-    if s < 0: return ""
-    s += len(o)
-    e = xml.find(c, s)
-    return decode_xml(xml[s:e]) if e >= 0 else ""
-
-def all_tag_values(xml, tag):
-    out, o, c, p = [], f"<{tag}>", f"</{tag}>", 0
-    while True:
-        s = xml.find(o, p)
-        if s < 0: break
-        s += len(o)
-        e = xml.find(c, s)
-        if e < 0: break
-        out.append(decode_xml(xml[s:e]))
-        p = e + len(c)
-    return out
-
-def get_program_url(px):
-    hit = px.find("/programme-neuf-")
-    if hit < 0: return ""
-    s = px.rfind("<URL>", 0, hit)
-    if s < 0: return ""
-    s += 5
-    e = px.find("</URL>", s)
-    return decode_xml(px[s:e]) if e >= 0 else ""
-
-def get_points_forts(px):
-    s = px.find("<POINTS_FORTS>")
-    if s < 0: return []
-    e = px.find("</POINTS_FORTS>", s)
-    if e < 0: return []
-    return all_tag_values(px[s:e + 15], "PF")
+    return normalize_ws(DECODE_PATTERN.sub(decode_match, v))
+
+# Serialized node content: a CDATA section, a child tag, or escaped text
+SERIAL_PATTERN = re.compile(r"<!\[CDATA\[([\s\S]*?)\]\]>|<[^>]*>|([^<]+)")
+
+def cdata_decoded_text(node):
+    """Node text with the entities inside CDATA decoded too, as the old parser did"""
+    out = []
+    for m in SERIAL_PATTERN.finditer(etree.tostring(node, encoding=str, with_tail=False)):
+        cdata, text = m.groups()
+        if cdata is not None: out.append(DECODE_PATTERN.sub(decode_match, cdata))
+        elif text is not None: out.append(unescape(text, {"&#13;": "\r"}))
+        else: out.append(" ")
+    return "".join(out)
+
+def node_text(node):
+    if node is None: return ""
+    # Child tags (<br/>, <p>) separate words, as they did in the old string parser
+    v = " ".join(node.itertext())
+    # libxml2 decoded the markup once but left CDATA content as is; only the
+    # serialized form tells the two apart
+    if "&" in v: v = cdata_decoded_text(node)
+    return normalize_ws(v)
+
+# First occurrence of each of these tags inside a PROGRAMME is kept
+PROGRAM_FIELDS = ("REF_OPERATION", "NUMERO", "NOM", "VILLE", "CP", "DEPARTEMENT",
+                  "PROMESSE_PROGRAMME", "DESCRIPTIF_COURT", "DESCRIPTIF_LONG",
+                  "DESCRIPTIF_CENTRE_D_APPEL", "POINTS_FORTS", "PERSPECTIVES")
+
+def scan_program(elem):
+    """Walk a PROGRAMME element once, collecting the nodes we care about"""
+    nodes, url = {}, ""
+    for node in elem.iter():
+        tag = node.tag
+        if tag == "URL":
+            if not url:
+                v = node_text(node)
+                if "/programme-neuf-" in v: url = v
+        elif tag in PROGRAM_FIELDS and tag not in nodes:
+            nodes[tag] = node
+    return nodes, url
+
+def get_points_forts(nodes):
+    pf = nodes.get("POINTS_FORTS")
+    if pf is None: return []
+    return [node_text(n) for n in pf.iter("PF")]
 
 def clean_text(v):
-    v = decode_xml(v or "")
-    v = re.sub(r"<[^>]*>", " ", v)
-    return re.sub(r"\s+", " ", v).strip()
+    if not v: return ""
+    # libxml2 already decoded the XML layer; only escaped HTML inside it is left
+    if "&" in v or "<![CDATA[" in v: v = decode_xml(v)
+    if "<" in v: v = TAG_PATTERN.sub(" ", v)
+    return normalize_ws(v)
 
-def build_arguments(px, name):
-    pfs = get_points_forts(px)
+def build_arguments(nodes, name):
+    pfs = get_points_forts(nodes)
     if pfs: return clean_text(" | ".join(pfs))
     for tag in ["PROMESSE_PROGRAMME", "DESCRIPTIF_COURT", "DESCRIPTIF_LONG",
                 "DESCRIPTIF_CENTRE_D_APPEL"]:
-        val = clean_text(tag_value(px, tag))
+        val = clean_text(node_text(nodes.get(tag)))
         if val: return val
     return name if name else "N/A"
 
-def get_program_image(px):
-    s = px.find("<PERSPECTIVES>")
-    if s < 0: return "NO IMAGE"
-    e = px.find("</PERSPECTIVES>", s)
-    if e < 0: return "NO IMAGE"
-    urls = all_tag_values(px[s:e + 15], "URL")
-    return urls[0] if urls and urls[0] else "NO IMAGE"
-
-def cut(v, n):
-    v = v or ""
-    return v[:n] if len(v) > n else v
+def get_program_image(nodes):
+    persp = nodes.get("PERSPECTIVES")
+    if persp is None: return "NO IMAGE"
+    url = node_text(next(persp.iter("URL"), None))
+    return url if url else "NO IMAGE"
 
 # =============================================================================
 # PARSER
 # =============================================================================
 
-def parse_xml(raw):
-    end = raw.find("</REPONSE>")
-    if end > -1: raw = raw[:end + 10]
+def release(elem):
+    """Drop a parsed PROGRAMME and the already-handled siblings before it"""
+    elem.clear(keep_tail=True)
+    parent = elem.getparent()
+    while elem.getprevious() is not None:
+        del parent[0]
 
-    dedup, programs = {}, []
+def parse_programs(source, encoding=None, log=print):
+    """Strict parse; raises XMLSyntaxError rather than return a partial list"""
+    dedup, programs = set(), []
     scanned, skipped, dups = 0, 0, 0
-    pos = 0
-
-    while True:
-        ps = raw.find("<PROGRAMME>", pos)
-        if ps < 0: break
-        pe = raw.find("</PROGRAMME>", ps)
-        if pe < 0: break
-        pe += len("</PROGRAMME>")
-        pos = pe
-        scanned += 1
-
-        p = raw[ps:pe]
-        ref  = tag_value(p, "REF_OPERATION") or tag_value(p, "NUMERO")
-        name = tag_value(p, "NOM")
-        city = tag_value(p, "VILLE")
-        zip_ = tag_value(p, "CP")
-        dept = tag_value(p, "DEPARTEMENT")
-        url  = get_program_url(p)
-
-        if not all([ref, name, city, zip_, dept, url]):
-            skipped += 1; continue
-        if "/programme-neuf-" not in url:
-            skipped += 1; continue
-
-        key = f"{ref}||{url}"
-        if key in dedup:
-            dups += 1; continue
-        dedup[key] = True
-
-        if len(programs) < 3:
-            print(f"[PARSE] #{len(programs)+1}: ref={ref} name={name}")
-
-        programs.append({
-            "Program_URL":        cut(url, 500),
-            "Program_Ref":        cut(ref, 50),
-            "Program_Name":       cut(name, 255),
-            "Program_City":       cut(city, 100),
-            "Program_ZipCode":    cut(zip_, 10),
-            "Program_Department": cut(dept, 2),
-            "Program_Arguments":  cut(build_arguments(p, name), 4000),
-            "Scraping_Date":      datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "Scraping_Status":    "SUCCESS",
-            "Error_Message":      "",
-            "Program_Image":      cut(get_program_image(p) or "NO IMAGE", 500),
-        })
-
-    print(f"[PARSE] Scanned={scanned} Valid={len(programs)} Skipped={skipped} Dups={dups}")
+    scraping_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    # Strict on purpose: recover mode silently drops stray '&', unknown
+    # entities and everything after a raw '<'
+    context = etree.iterparse(source, events=("end",), tag="PROGRAMME", huge_tree=True,
+                              strip_cdata=False, encoding=encoding)
+    try:
+        for _, elem in context:
+            scanned += 1
+            try:
+                # scan_program only returns /programme-neuf- URLs
+                nodes, url = scan_program(elem)
+                ref = node_text(nodes.get("REF_OPERATION")) or node_text(nodes.get("NUMERO"))
+                if not (ref and url):
+                    skipped += 1; continue
+
+                key = (ref, url)
+                if key in dedup:
+                    dups += 1; continue
+
+                name = node_text(nodes.get("NOM"))
+                city = node_text(nodes.get("VILLE"))
+                zip_ = node_text(nodes.get("CP"))
+                dept = node_text(nodes.get("DEPARTEMENT"))
+                if not (name and city and zip_ and dept):
+                    skipped += 1; continue
+                dedup.add(key)
+
+                if len(programs) < 3:
+                    log(f"[PARSE] #{len(programs)+1}: ref={ref} name={name}")
+
+                programs.append({
+                    "Program_URL":        url[:500],
+                    "Program_Ref":        ref[:50],
+                    "Program_Name":       name[:255],
+                    "Program_City":       city[:100],
+                    "Program_ZipCode":    zip_[:10],
+                    "Program_Department": dept[:2],
+                    "Program_Arguments":  build_arguments(nodes, name)[:4000],
+                    "Scraping_Date":      scraping_date,
+                    "Scraping_Status":    "SUCCESS",
+                    "Error_Message":      "",
+                    "Program_Image":      get_program_image(nodes)[:500],
+                })
+            finally:
+                release(elem)
+    except etree.XMLSyntaxError as e:
+        # Partner files sometimes carry garbage after </REPONSE>; every
+        # PROGRAMME has been seen by then
+        if e.code != etree.ErrorTypes.ERR_DOCUMENT_END: raise
+
+    log(f"[PARSE] Scanned={scanned} Valid={len(programs)} Skipped={skipped} Dups={dups}")
     return programs
 
+def parse_xml(source, log=print):
+    """Return the valid programs, or None if the file can't be read even leniently"""
+    try:
+        return parse_programs(source, log=log)
+    except etree.XMLSyntaxError as e:
+        log(f"[PARSE] XML error ({e}), re-reading leniently")
+
+    # A partial list would be inserted, marked and archived: it's all or nothing
+    source.seek(0)
+    try:
+        # repair_xml re-encodes as UTF-8, whatever the declaration says
+        return parse_programs(BytesIO(repair_xml(source.read())), encoding="utf-8", log=log)
+    except etree.XMLSyntaxError as e:
+        log(f"[PARSE] XML error: {e}")
+        return None
+
+# Returned by fetch_programs_worker when the server refuses another session
+NO_CONNECTION = object()
+
+def fetch_programs(sftp, filename, log=print):
+    with ftp_download(sftp, safe_join(INCOMING_DIR, filename), log) as f:
+        return parse_xml(f, log)
+
+def fetch_programs_worker(filename):
+    """Same as fetch_programs, on a dedicated connection (paramiko transports are not
+    thread-safe). Returns (programs, log lines) so main prints them under the file's header"""
+    lines = []
+    try:
+        transport, sftp = ftp_connect(lines.append)
+    except Exception as e:
+        lines.append(f"[FTP] Extra connection refused: {e}")
+        return NO_CONNECTION, lines
+    try:
+        return fetch_programs(sftp, filename, lines.append), lines
+    finally:
+        sftp.close()
+        transport.close()
+
 # =============================================================================
 # MAIN
 # =============================================================================
@@ -334,6 +471,7 @@ def main():
 
     # Connect FTP
     transport, sftp = ftp_connect()
+    marks, rejected = [], []
 
     try:
         # Load processed list
@@ -362,43 +500,67 @@ def main():
         # Authenticate to SFMC
         token = sfmc_auth()
 
-        for filename, mtime, size in to_process:
-            xml_path = safe_join(INCOMING_DIR, filename)
-            print("-" * 60)
-            print(f"[PROCESS] {xml_path} ({size:,} bytes)")
-
-            # Download XML
-            xml_content = ftp_download(sftp, xml_path)
-
-            # Parse
-            programs = parse_xml(xml_content)
-            if not programs:
-                print("[WARN] No valid programs. Marking as processed.")
-                mark_processed(sftp, filename, size, mtime)
-                continue
-
-            # Insert to DE via async API
-            ok, err = sfmc_insert_all(token, programs)
-            print(f"[RESULT] {ok} rows submitted, {err} errors")
-
-            # Mark processed
-            mark_processed(sftp, filename, size, mtime)
-
-            # Archive XML
-            archive_path = safe_join(ARCHIVE_DIR, filename)
-            try:
-                ftp_rename(sftp, xml_path, archive_path)
-                print(f"[ARCHIVE] {xml_path} → {archive_path}")
-            except Exception as e:
-                print(f"[ARCHIVE] Could not move: {e}")
+        with ThreadPoolExecutor(max_workers=max(FTP_WORKERS, 1)) as pool:
+            # Download + parse XML: with FTP_WORKERS > 1, several files go through
+            # worker connections in parallel; results still come back in mtime order
+            fetched = None
+            if FTP_WORKERS > 1 and len(to_process) > 1:
+                fetched = pool.map(fetch_programs_worker, [filename for filename, _, _ in to_process])
+
+            for filename, mtime, size in to_process:
+                xml_path = safe_join(INCOMING_DIR, filename)
+                print("-" * 60)
+                print(f"[PROCESS] {xml_path} ({size:,} bytes)")
+
+                if fetched is None:
+                    programs = fetch_programs(sftp, filename)
+                else:
+                    programs, lines = next(fetched)
+                    for line in lines: print(line)
+                    if programs is NO_CONNECTION:
+                        print("[FTP] Falling back to the main connection")
+                        programs = fetch_programs(sftp, filename)
+
+                if programs is None:
+                    print("[ERROR] Unreadable XML. Leaving it in incoming, not marked.")
+                    rejected.append(filename)
+                    continue
+
+                if not programs:
+                    print("[WARN] No valid programs. Marking as processed.")
+                    mark_processed(marks, filename, size, mtime)
+                    continue
+
+                # Insert to DE via async API
+                ok, err = sfmc_insert_all(token, programs)
+                print(f"[RESULT] {ok} rows submitted, {err} errors")
+
+                # Mark processed
+                mark_processed(marks, filename, size, mtime)
+
+                # Archive XML
+                archive_path = safe_join(ARCHIVE_DIR, filename)
+                try:
+                    ftp_rename(sftp, xml_path, archive_path)
+                    print(f"[ARCHIVE] {xml_path} → {archive_path}")
+                except Exception as e:
+                    print(f"[ARCHIVE] Could not move: {e}")
 
         print("=" * 60)
-        print(f"[DONE] Processed {len(to_process)} file(s)")
+        print(f"[DONE] Processed {len(to_process) - len(rejected)} file(s), rejected {len(rejected)}")
+        for filename in rejected:
+            print(f"[DONE] Rejected: {filename}")
         print("=" * 60)
 
     finally:
-        sftp.close()
-        transport.close()
+        try:
+            save_processed(sftp, marks)
+        finally:
+            sftp.close()
+            transport.close()
+
+    # Fail the workflow run so a stalled feed gets noticed
+    if rejected: sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -4,7 +4,7 @@ Debug version - checks what's actually in /bi/incoming
 """
 
 import os
-import re
+import stat
 import sys
 from datetime import datetime
 from io import BytesIO
@@ -24,12 +24,13 @@ FTP_PASSWORD = os.environ.get("FTP_PASSWORD", "")
 INCOMING_DIR  = os.environ.get("INCOMING_DIR",  "/bi/incoming")
 PROCESSED_LOG = os.environ.get("PROCESSED_LOG", "/bi/processed/processed.log")
 
-XML_PATTERN = re.compile(r".*\.xml$", re.IGNORECASE)
-
 # =============================================================================
 # FTP HELPERS
 # =============================================================================
 
+def is_dir(attr):
+    return stat.S_ISDIR(attr.st_mode or 0)
+
 def ftp_connect():
     print(f"[FTP] Connecting to {FTP_HOST}:{FTP_PORT}...")
     transport = paramiko.Transport((FTP_HOST, FTP_PORT))
@@ -58,20 +59,20 @@ def list_incoming_xml_debug(sftp):
         print(f"[DEBUG] Found {len(items)} total items")
         
         for it in items:
-            is_dir = it.longname.startswith("d")
-            matches_pattern = XML_PATTERN.match(it.filename)
+            directory = is_dir(it)
+            is_xml = it.filename.lower().endswith(".xml")
             
             print(f"\n[DEBUG] Item: {it.filename}")
             print(f"  - Longname: {it.longname}")
-            print(f"  - Is directory: {is_dir}")
-            print(f"  - Matches XML pattern: {matches_pattern}")
+            print(f"  - Is directory: {directory}")
+            print(f"  - Is .xml: {is_xml}")
             print(f"  - Size: {it.st_size} bytes")
             print(f"  - Modified: {datetime.fromtimestamp(it.st_mtime)}")
         
         # Now filter for XML files
         files = []
         for it in items:
-            if not it.longname.startswith("d") and XML_PATTERN.match(it.filename):
+            if not is_dir(it) and it.filename.lower().endswith(".xml"):
                 files.append((it.filename, it.st_mtime, it.st_size))
         
         files.sort(key=lambda x: x[1])